@@ -0,0 +1,292 @@
+"""Tests for `xmanager`. Run by `python -m unittest`."""
+
+import collections
+import enum
+import json
+import os
+import pathlib
+import tempfile
+import unittest
+from unittest import mock
+
+import xmanager
+from xmanager import XManager
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class _Color(enum.Enum):
+    RED = 'red'
+
+
+class _Level(enum.IntEnum):
+    LOW = 1
+
+
+class _Name(str):
+    pass
+
+
+class _Config:
+
+    def __init__(self):
+        self.lr = 0.1
+        self.layers = [1, 2]
+        self._hidden = object()
+
+
+_Point = collections.namedtuple('_Point', 'x y')
+
+
+def _params():
+    params = {
+        'int': 1,
+        'big_int': 2 ** 70,
+        'float': 0.5,
+        'nan': float('nan'),
+        'inf': float('inf'),
+        'neg_inf': float('-inf'),
+        'none': None,
+        'text': 'naïve',
+        'name': _Name('subclass'),
+        'tuple': (1, 'a'),
+        'dict': {'k': [1, 2.5, None, True], 1: 'int-key'},
+        'ordered': collections.OrderedDict(a=1),
+        'default': collections.defaultdict(list, b=[2]),
+        'point': _Point(1, 2),
+        'color': _Color.RED,
+        'level': _Level.LOW,
+        'level_keyed': {_Level.LOW: 'low'},
+        'config': _Config(),
+    }
+    if np is not None:
+        params.update({
+            'np_int': np.int64(3),
+            'np_float': np.float32(1.5),
+            'np_bool': np.bool_(True),
+            'small_array': np.arange(6.0).reshape(2, 3),
+            'nan_array': np.array([1.0, np.nan]),
+            'object_nan_array': np.array([1.0, np.nan], dtype=object),
+            'large_array': np.arange(10000, dtype='float64'),
+            'strided_array': np.arange(40000, dtype='>i4')[::2],
+        })
+    return params
+
+
+class _XManagerTestCase(unittest.TestCase):
+    """Runs each test with a temporary directory for the `XManager`s."""
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmp_dir.cleanup)
+        # Do not copy the test runner as the source.
+        patcher = mock.patch.object(xmanager, '_SCRIPT_PATH', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class TestSaveParams(_XManagerTestCase):
+
+    def _save(self, params, use_orjson):
+        xm = XManager(self._tmp_dir.name)
+        for k, v in params.items():
+            setattr(xm, k, v)
+        orjson = xmanager.orjson if use_orjson else None
+        with mock.patch.object(xmanager, 'orjson', orjson):
+            xm.save_params()
+        with open(xm.get_path('params.json')) as f:
+            return json.load(f)
+
+    @unittest.skipIf(xmanager.orjson is None, 'orjson is not installed')
+    def test_same_with_or_without_orjson(self):
+        params = _params()
+        # NaN is not equal to itself, so compare the dumps.
+        self.assertEqual(
+            json.dumps(self._save(params, use_orjson=True)),
+            json.dumps(self._save(params, use_orjson=False)),
+        )
+        # Without what orjson falls back to `json` for, the dump by orjson
+        # itself is the same too.
+        params = {
+            k: v for k, v in params.items()
+            if k not in ('big_int', 'nan', 'inf', 'neg_inf', 'dict',
+                         'level_keyed', 'nan_array', 'object_nan_array')
+        }
+        with mock.patch.object(xmanager, '_json_encoder', None):
+            saved_by_orjson = self._save(params, use_orjson=True)
+        self.assertEqual(
+            json.dumps(saved_by_orjson),
+            json.dumps(self._save(params, use_orjson=False)),
+        )
+
+    @unittest.skipIf(xmanager.orjson is None, 'orjson is not installed')
+    @unittest.skipIf(np is None, 'numpy is not installed')
+    def test_object_array_nan_with_or_without_orjson(self):
+        params = {'a': np.array([1.0, np.nan], dtype=object), 'b': None}
+        self.assertEqual(
+            json.dumps(self._save(params, use_orjson=True)),
+            json.dumps(self._save(params, use_orjson=False)),
+        )
+
+    def test_invalid_keys_rejected(self):
+        for k in (_Color.RED, (1, 2)):
+            xm = XManager(self._tmp_dir.name)
+            xm.keyed = {k: 1}
+            with self.assertRaisesRegex(TypeError, 'keys must be'):
+                xm.get_params()
+            with self.assertRaisesRegex(TypeError, 'keys must be'):
+                xm.save_params()
+            with mock.patch.object(xmanager, 'orjson', None):
+                with self.assertRaisesRegex(TypeError, 'keys must be'):
+                    xm.save_params()
+
+    def test_same_as_get_params(self):
+        params = _params()
+        xm = XManager(self._tmp_dir.name)
+        for k, v in params.items():
+            setattr(xm, k, v)
+        self.assertEqual(
+            json.dumps(xm.get_params()),
+            json.dumps(self._save(params, use_orjson=False)),
+        )
+
+    def test_saved_values(self):
+        saved = self._save(_params(), use_orjson=xmanager.orjson is not None)
+        self.assertEqual(saved['big_int'], 2 ** 70)
+        self.assertNotEqual(saved['nan'], saved['nan'])
+        self.assertEqual(saved['inf'], float('inf'))
+        self.assertEqual(saved['name'], 'subclass')
+        self.assertEqual(saved['default'], {'b': [2]})
+        self.assertEqual(saved['point'], [1, 2])
+        self.assertEqual(saved['color'], 'red')
+        self.assertEqual(saved['level'], 1)
+        self.assertEqual(saved['config'], {'lr': 0.1, 'layers': [1, 2]})
+
+    @unittest.skipIf(np is None, 'numpy is not installed')
+    def test_arrays_recovered(self):
+        params = _params()
+        saved = XManager.unjsonfy(
+            self._save(params, use_orjson=xmanager.orjson is not None))
+        self.assertIsInstance(saved['small_array'], list)
+        for k in ('large_array', 'strided_array'):
+            np.testing.assert_array_equal(saved[k], params[k])
+            self.assertEqual(saved[k].dtype, params[k].dtype)
+
+
+class TestAsyncSaveParams(_XManagerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.xm = XManager(self._tmp_dir.name)
+        # Large enough to be written in background.
+        self.xm.log = 'x' * xmanager._ASYNC_IO_MIN_SIZE
+
+    def test_last_save_wins(self):
+        for epoch in range(20):
+            self.xm.epoch = epoch
+            self.xm.save_params(async_io=True)
+        self.xm.save_params(async_io=True).join()
+        with open(self.xm.get_path('params.json')) as f:
+            self.assertEqual(json.load(f)['epoch'], 19)
+        self.assertEqual(os.listdir(self.xm.x_dir), ['params.json'])
+
+    def test_error_raised_by_join(self):
+        with mock.patch.object(
+                xmanager, '_replace_file', side_effect=OSError('disk full')):
+            writer = self.xm.save_params(async_io=True)
+            with self.assertRaisesRegex(OSError, 'disk full'):
+                writer.join()
+        # Raised only once.
+        self.xm.save_params()
+
+    def test_error_raised_by_next_save(self):
+        with mock.patch.object(
+                xmanager, '_replace_file', side_effect=OSError('disk full')):
+            self.xm.save_params(async_io=True)
+            with self.assertRaisesRegex(OSError, 'disk full'):
+                self.xm.save_params()
+        self.xm.save_params()
+        with open(self.xm.get_path('params.json')) as f:
+            self.assertEqual(len(json.load(f)['log']), len(self.xm.log))
+
+
+class TestGetPath(_XManagerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.xm = XManager(self._tmp_dir.name)
+
+    def test_ensure_dir(self):
+        self.assertTrue(os.path.isdir(self.xm.get_path('.cache')))
+        self.assertTrue(os.path.isdir(self.xm.get_path('figs')))
+        path = self.xm.get_path('models', 'model.pt')
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(os.path.isdir(os.path.dirname(path)))
+        path = self.xm.get_path('.hidden.txt')
+        self.assertFalse(os.path.exists(path))
+
+    def test_same_as_os_path_join(self):
+        for file_or_dir in [
+                ('a',), ('a', 'b.txt'), ('a', ''), ('',), ('', 'b'),
+                ('a/', 'b'), ('a', '/abs'), (pathlib.Path('a'), 'b.txt')]:
+            self.assertEqual(
+                self.xm.get_path(*file_or_dir, ensure_dir=False),
+                os.path.join(self.xm.x_dir, *file_or_dir),
+            )
+
+
+class TestParams(_XManagerTestCase):
+
+    def test_internals_not_in_params(self):
+        xm = XManager(self._tmp_dir.name)
+        xm.lr = 0.1
+        self.assertEqual(xm.lr, 0.1)
+        self.assertEqual(xm.get_params(), {'lr': 0.1})
+        del xm.lr
+        self.assertEqual(xm.get_params(), {})
+
+    def test_subclass_slots_not_in_params(self):
+
+        class MyXManager(XManager):
+            __slots__ = ('tag',)
+
+        xm = MyXManager(self._tmp_dir.name)
+        xm.tag = 'a'
+        xm.lr = 0.1
+        self.assertEqual(xm.tag, 'a')
+        self.assertEqual(xm.get_params(), {'lr': 0.1})
+
+
+class TestCopySource(unittest.TestCase):
+
+    def test_mode_of_copy(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            src = os.path.join(tmp_dir, 'script.py')
+            dst = os.path.join(tmp_dir, 'source.py')
+            with open(src, 'w') as f:
+                f.write('print(1)\n')
+            XManager._copy_source(src, dst)
+            with open(dst) as f:
+                self.assertEqual(f.read(), 'print(1)\n')
+            # Not executable, as `shutil.copyfile` gives.
+            self.assertEqual(os.stat(dst).st_mode & 0o111, 0)
+
+    @unittest.skipIf(not hasattr(os, 'copy_file_range'),
+                     'os.copy_file_range is not available')
+    def test_copy_file_range_copies_nothing(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            src = os.path.join(tmp_dir, 'script.py')
+            dst = os.path.join(tmp_dir, 'source.py')
+            with open(src, 'w') as f:
+                f.write('print(1)\n')
+            with mock.patch.object(os, 'copy_file_range', return_value=0):
+                XManager._copy_source(src, dst)
+            with open(dst) as f:
+                self.assertEqual(f.read(), 'print(1)\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,14 +1,218 @@
 """A simple experiment manager in a single Python file."""
 
 import os
+import errno
 import sys
 import pathlib
 import shutil
+import threading
+import itertools
+import functools
 import json
-import numpy as np
-from typing import Dict, Any
+import base64
+import math
+import enum
+import uuid
+from typing import Dict, Any, Union
 from datetime import datetime
 
+try:
+    import orjson
+except ImportError:
+    # orjson is optional, falling back to the standard `json` module.
+    orjson = None
+
+if orjson is not None:
+    # Leave what orjson serializes differently from `json` to `_json_default`,
+    # so that `params.json` is the same with or without orjson. The dicts with
+    # non-str keys are rejected by orjson, and so left to `json`, which checks
+    # the keys.
+    _ORJSON_OPTIONS = (
+        orjson.OPT_INDENT_2
+        | orjson.OPT_PASSTHROUGH_SUBCLASS
+        | orjson.OPT_PASSTHROUGH_DATACLASS
+        | orjson.OPT_PASSTHROUGH_DATETIME
+    )
+
+# Types that JSON serializes as scalars.
+_JSON_SCALAR = (str, int, float, bool, type(None))
+
+# The errors of `os.copy_file_range` where `shutil.copyfile` is used instead.
+_COPY_FILE_RANGE_ERRNOS = (
+    errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP)
+
+# The least size in bytes of the params dump to be written asynchronously.
+_ASYNC_IO_MIN_SIZE = 1 << 16
+
+# The path to the running script, resolved once. If in RELP, sys.argv[0] will
+# be empty.
+_SCRIPT_PATH = os.path.realpath(sys.argv[0]) if sys.argv[0] else None
+
+# Numbers the XManagers instantiated in this process.
+_stamp_counter = itertools.count()
+
+# If the paths can be joined by string concatenation.
+_FAST_JOIN = os.sep == '/' and os.altsep is None
+
+# The largest size in bytes of the arrays to be JSONfied as lists. The larger
+# ones are JSONfied as base64 encoded bytes.
+_NDARRAY_LIST_MAX_NBYTES = 1 << 16
+
+
+def _numpy_types():
+    """Returns `(np.ndarray, np.generic)`, or empty tuples if numpy has not
+    been imported, in which case no numpy object can be met. So, numpy is not
+    imported by this module for checking the types.
+    """
+    np = sys.modules.get('numpy')
+    if np is None:
+        return (), ()
+    return np.ndarray, np.generic
+
+
+@functools.lru_cache(maxsize=1024)
+def _dir_to_ensure(path: str) -> str:
+    """Returns the directory to ensure for the `path`. Cached, since the same
+    paths are often got repeatedly, like a checkpoint saved in each epoch.
+    """
+    # It is taken as a file if its name has an extension, like `a.png`. But
+    # the leading dots do not start an extension, like `.cache`.
+    if '.' in os.path.basename(path).lstrip('.'):
+        return os.path.dirname(path)
+    return path
+
+
+# Registers how the objects of a type are JSONfied, by the kind of the type:
+# 'scalar', 'ndarray', 'item' (numpy scalars, JSONfied by `.item()`), 'enum'
+# (JSONfied by its value), 'uuid', 'container' (dict, list and tuple), 'object'
+# (JSONfied by its `__dict__`), or 'invalid' (not JSON-serializable). They are
+# in accordance with `XManager._json_default`.
+_json_kinds: Dict[type, str] = {t: 'scalar' for t in _JSON_SCALAR}
+_json_kinds.update({dict: 'container', list: 'container', tuple: 'container'})
+
+# Marks the objects being JSONfied, for detecting circular references.
+_PENDING = object()
+
+
+def _register_json_kind(x) -> str:
+    """Determines the kind of the type of `x` and registers it, so that the
+    types are checked only once for each type.
+    """
+    ndarray, generic = _numpy_types()
+    if isinstance(x, ndarray):
+        kind = 'ndarray'
+    elif isinstance(x, generic):
+        kind = 'item'
+    elif isinstance(x, enum.Enum):
+        kind = 'enum'
+    elif isinstance(x, uuid.UUID):
+        kind = 'uuid'
+    elif isinstance(x, (dict, list, tuple)):
+        kind = 'container'
+    # Check serializablility without encoding the value.
+    elif isinstance(x, _JSON_SCALAR):
+        kind = 'scalar'
+    elif hasattr(x, '__dict__'):
+        kind = 'object'
+    else:
+        kind = 'invalid'
+    _json_kinds[type(x)] = kind
+    return kind
+
+
+def _check_json_keys(x: dict):
+    """Raises `TypeError` if any key of `x` is not accepted by `json`."""
+    for k in x:
+        if type(k) not in _JSON_SCALAR and not isinstance(k, _JSON_SCALAR):
+            raise TypeError(
+                'keys must be str, int, float, bool or None, '
+                f'not {type(k).__name__}')
+
+
+def _has_nonfinite(x) -> bool:
+    """Returns if there is any NaN or infinity in `x`, which orjson writes as
+    `null`, while `json` writes as `NaN`, `Infinity` or `-Infinity`.
+    """
+    ndarray, generic = _numpy_types()
+    visited = set()
+    stack = [x]
+    while stack:
+        obj = stack.pop()
+        if type(obj) in _JSON_SCALAR:
+            if type(obj) is float and not math.isfinite(obj):
+                return True
+            continue
+        if isinstance(obj, (ndarray, generic)):
+            # The object arrays are JSONfied as lists of their objects.
+            if obj.dtype.kind == 'O':
+                stack.append(obj.tolist())
+                continue
+            np = sys.modules['numpy']
+            if obj.dtype.kind in 'fc' and not np.isfinite(obj).all():
+                return True
+            continue
+        if isinstance(obj, float):
+            if not math.isfinite(obj):
+                return True
+            continue
+        if id(obj) in visited:
+            continue
+        visited.add(id(obj))
+        if isinstance(obj, enum.Enum):
+            stack.append(obj.value)
+        elif isinstance(obj, dict):
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple)):
+            stack.extend(obj)
+        elif hasattr(obj, '__dict__'):
+            stack.extend(
+                v for k, v in vars(obj).items() if not k.startswith('_'))
+    return False
+
+
+def _replace_file(path: str, write):
+    """Writes the file `path` by `write(f)`, into a temporary file at first,
+    which then replaces `path`. So, `path` is never left partially written.
+    """
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class _ParamsWriter(threading.Thread):
+    """Thread writing the params dump to `path`. The error of the writing, if
+    any, is raised by `join`.
+    """
+
+    def __init__(self, path: str, data: bytes):
+        super().__init__(name='XManagerParamsWriter')
+        self.path = path
+        self.data = data
+        self.error = None
+
+    def run(self):
+        try:
+            _replace_file(self.path, lambda f: f.write(self.data))
+        except BaseException as e:
+            self.error = e
+        finally:
+            self.data = None
+
+    def join(self, timeout=None):
+        super().join(timeout)
+        # Raised only once, by whoever joins first.
+        error, self.error = self.error, None
+        if error is not None:
+            raise error
+
 
 class XManager:
     """Manager for experiments.
@@ -18,7 +222,8 @@ class XManager:
  
     ```python
     # Initialize.
-    # This will generate a path `experiments/1/<datetime>/`.
+    # This will generate a path `experiments/1/<datetime>/`, where the
+    # `<datetime>` is like `2022-01-31-12-00-00-000`, ended with a counter.
     # It will also copy this script to ``experiments/1/<datetime>/source.py`,
     # except for REPL mode, where script cannot be copied.
     xm = XManager('experiments', '1')
@@ -40,53 +245,128 @@ class XManager:
     ```
     """
 
+    # The attributes used by XManager itself. So, the `__dict__` holds only the
+    # parameters, which are read and written as usual attributes. This does not
+    # make the instances smaller: the `__dict__` is kept for the parameters,
+    # and the slots are in addition to it.
+    __slots__ = (
+        'x_dir', '_x_dir_prefix', '_ensured', '_writer',
+        '__dict__', '__weakref__',
+    )
+
     def __init__(self, *base_dir: str):
-        base_dir = os.path.join(*base_dir)
+        base_dir = os.path.join(*base_dir) if base_dir else ''
+        if not os.path.isabs(base_dir):
+            base_dir = os.path.join(os.getcwd(), base_dir)
 
-        self.x_dir = os.path.join(
-            os.path.abspath(base_dir),
-            datetime.now().strftime('%Y-%m-%d-%H-%M-%S'),
+        # The counter keeps the XManagers instantiated within the same second
+        # from sharing a directory.
+        now = datetime.now()
+        stamp = (
+            f'{now.year:04d}-{now.month:02d}-{now.day:02d}-'
+            f'{now.hour:02d}-{now.minute:02d}-{now.second:02d}-'
+            f'{next(_stamp_counter):03d}'
         )
-        XManager._ensure_dir(self.x_dir)
+        self.x_dir = os.path.normpath(os.path.join(base_dir, stamp))
+        pathlib.Path(self.x_dir).mkdir(parents=True, exist_ok=True)
+        self._x_dir_prefix = self.x_dir + os.sep
+        # The directories that have been ensured to exist in this session.
+        self._ensured = {self.x_dir}
+        # The thread writing `params.json` in background, if any.
+        self._writer = None
 
-        # If in RELP, sys.argv[0] will be empty.
-        if sys.argv[0]:
-            script_path = os.path.realpath(sys.argv[0])
-            shutil.copy(script_path, self.get_path('source.py'))
+        if _SCRIPT_PATH is not None:
+            XManager._copy_source(_SCRIPT_PATH, self.get_path('source.py'))
 
     @classmethod
-    def _is_dir(cls, path: str):
-        """Determines if it is a folder by checking file extension."""
-        ext = os.path.splitext(path)[-1]
-        # If it is a folder, ext is an empty string (i.e. '').
-        return True if ext == '' else False
+    def _copy_source(cls, src: str, dst: str):
+        """Copies the file `src` to `dst`, within the kernel if possible.
 
-    @classmethod
-    def _ensure_dir(cls, path: str):
-        if cls._is_dir(path):
-            dir_path = path
-        else:
-            dir_path = os.path.dirname(path)
-        pathlib.Path(dir_path).mkdir(parents=True, exist_ok=True) 
+        The mode bits are not copied, which is not needed for a snapshot of the
+        source.
+        """
+        if hasattr(os, 'copy_file_range'):
+            src_fd = os.open(src, os.O_RDONLY)
+            try:
+                dst_fd = os.open(
+                    dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+                try:
+                    copied = 0
+                    while True:
+                        n = os.copy_file_range(src_fd, dst_fd, 1 << 20)
+                        if not n:
+                            break
+                        copied += n
+                    # Some file systems give 0 instead of an error, before the
+                    # end of file, in which case `shutil.copyfile` is used.
+                    if copied and copied >= os.fstat(src_fd).st_size:
+                        return
+                except OSError as e:
+                    # Not supported for the files, e.g. across file systems.
+                    if e.errno not in _COPY_FILE_RANGE_ERRNOS:
+                        raise
+                finally:
+                    os.close(dst_fd)
+            finally:
+                os.close(src_fd)
+        shutil.copyfile(src, dst)
 
-    def get_path(self, *file_or_dir: str, ensure_dir=True):
+    def _ensure_dir(self, dir_path: str):
+        """Creates the directory `dir_path` if it does not exist."""
+        if dir_path in self._ensured:
+            return
+        pathlib.Path(dir_path).mkdir(parents=True, exist_ok=True)
+
+        # The parents are created along the way, so they are ensured too.
+        while dir_path not in self._ensured:
+            self._ensured.add(dir_path)
+            parent = os.path.dirname(dir_path)
+            if parent == dir_path:
+                break
+            dir_path = parent
+
+    def get_path(self, *file_or_dir: Union[str, os.PathLike], ensure_dir=True):
         """
         Args:
-            file_or_dir (str): Relative path to a file or directory.
-            ensure_dir (bool, optional): When it is a directory but does not
-                exist, create one if `ensure_dir` is true.
+            file_or_dir (str or os.PathLike): Relative path to a file or
+                directory.
+            ensure_dir (bool, optional): If true, create the directory, or the
+                parent directory of the file, when it does not exist. It is
+                taken as a file when its name contains a `.` other than the
+                leading ones, like `a.png` but not `.cache`.
 
         Returns:
             str: The absolute path to the `file_or_dir`.
         """
-        path = os.path.join(self.x_dir, *file_or_dir)
+        if not file_or_dir:
+            path = self.x_dir
+        else:
+            try:
+                rel_path = os.sep.join(file_or_dir)
+            except TypeError:
+                # Not all `str`, like `pathlib.Path`.
+                rel_path = None
+            # `os.path.join` is needed on Windows, or when any component is
+            # absolute or ends with a separator, or is not a `str`.
+            if (_FAST_JOIN
+                    and rel_path is not None
+                    and not rel_path.startswith('/')
+                    and '//' not in rel_path):
+                path = self._x_dir_prefix + rel_path
+            else:
+                path = os.path.join(self.x_dir, *file_or_dir)
         if ensure_dir:
-            self._ensure_dir(path)
+            self._ensure_dir(_dir_to_ensure(path))
         return path
 
     @classmethod
     def jsonfy(cls, x):
         """Auxiliary class method for JSONfying an object x.
+
+        The object is walked iteratively, so that deep objects do not hit the
+        recursion limit, and an object referred to for many times is JSONfied
+        only once. The private attributes of an object, i.e. those starting
+        with `_`, are skipped.
         
         Args:
             x (object): Being any type of object.
@@ -96,37 +376,250 @@ class XManager:
         
         Raises:
             TypeError: When non JSON-serializable object is met.
+            ValueError: When circular reference is met.
         """
-        # np.ndarray is not JSON serializable.
-        if isinstance(x, np.ndarray):
+        # Maps `id(obj)` to the JSONfied `obj`. The objects are kept alive by
+        # `visited`, so that their `id`s are not reused during the walk.
+        memo: Dict[int, Any] = {}
+        visited = []
+        # Each item is `(obj, children)`, where `children` is `None` if `obj`
+        # is not expanded yet.
+        stack = [(x, None)]
+        while stack:
+            obj, children = stack.pop()
+            key = id(obj)
+
+            if children is not None:
+                # All the children have been JSONfied, post-order.
+                if isinstance(children, dict):
+                    memo[key] = {
+                        k: v if type(v) in _JSON_SCALAR else memo[id(v)]
+                        for k, v in children.items()
+                    }
+                else:
+                    memo[key] = [
+                        v if type(v) in _JSON_SCALAR else memo[id(v)]
+                        for v in children
+                    ]
+                continue
+
+            if key in memo:
+                if memo[key] is _PENDING:
+                    raise ValueError('Circular reference detected.')
+                continue
+            visited.append(obj)
+
+            kind = _json_kinds.get(type(obj)) or _register_json_kind(obj)
+            if kind == 'scalar':
+                memo[key] = obj
+                continue
+            # np.ndarray is not JSON serializable.
+            if kind == 'ndarray':
+                memo[key] = XManager._jsonfy_ndarray(obj)
+                continue
+            # Such as `np.int64`.
+            if kind == 'item':
+                memo[key] = obj.item()
+                continue
+            if kind == 'enum':
+                memo[key] = XManager.jsonfy(obj.value)
+                continue
+            if kind == 'uuid':
+                memo[key] = str(obj)
+                continue
+            if kind == 'container':
+                if isinstance(obj, dict):
+                    _check_json_keys(obj)
+                children = obj
+            elif kind == 'object':
+                attrs = vars(obj)
+                # Fast path for the objects holding only scalars, like configs.
+                if all(type(v) in _JSON_SCALAR for v in attrs.values()):
+                    memo[key] = {
+                        k: v for k, v in attrs.items() if not k.startswith('_')
+                    }
+                    continue
+                children = {
+                    k: v for k, v in attrs.items() if not k.startswith('_')
+                }
+            # TODO: convert other objects which are not JSON serializable.
+            else:
+                raise TypeError(
+                    f'Type "{type(obj)}" is not JSON-serializable.')
+
+            memo[key] = _PENDING
+            stack.append((obj, children))
+            if isinstance(children, dict):
+                stack.extend((v, None) for v in children.values()
+                             if type(v) not in _JSON_SCALAR)
+            else:
+                stack.extend((v, None) for v in children
+                             if type(v) not in _JSON_SCALAR)
+        return memo[id(x)]
+
+    @classmethod
+    def _jsonfy_ndarray(cls, x):
+        """Auxiliary class method for JSONfying a `np.ndarray` x.
+
+        Small arrays are converted to lists, for readability. Large numeric
+        arrays are encoded as the base64 of their bytes, instead of a list of
+        boxed numbers. Use `unjsonfy` for recovering them.
+
+        Args:
+            x (np.ndarray): The array.
+
+        Returns:
+            Union[list, dict]: The JSONfied array.
+        """
+        if x.nbytes <= _NDARRAY_LIST_MAX_NBYTES or x.dtype.kind not in 'biufc':
             return x.tolist()
+        # Encode from the buffer of the array, without copying it to bytes.
+        if not x.flags.c_contiguous:
+            x = x.copy(order='C')
+        data = base64.b64encode(x)
+        return {
+            '__ndarray__': data.decode('ascii'),
+            # With the byte order, like '<f8', for reading on any machine.
+            'dtype': x.dtype.str,
+            'shape': list(x.shape),
+        }
+
+    @classmethod
+    def unjsonfy(cls, x):
+        """Auxiliary class method for recovering the arrays in a JSONfied x.
+
+        Args:
+            x (object): The JSON object, such as the loaded `params.json`.
+
+        Returns:
+            object: The JSON object with the base64 encoded arrays recovered.
+        """
+        if isinstance(x, dict):
+            if '__ndarray__' in x:
+                import numpy as np
+                data = bytearray(base64.b64decode(x['__ndarray__']))
+                return np.frombuffer(data, x['dtype']).reshape(x['shape'])
+            return {k: XManager.unjsonfy(v) for k, v in x.items()}
+        if isinstance(x, list):
+            return [XManager.unjsonfy(xi) for xi in x]
+        return x
+
+    @classmethod
+    def _json_default(cls, x):
+        """Auxiliary class method for the objects that the JSON encoder cannot
+        serialize, used as the `default` of `json` and orjson.
+
+        Args:
+            x (object): Being any type of object.
+
+        Returns:
+            object: An object that the JSON encoder can serialize.
+
+        Raises:
+            TypeError: When non JSON-serializable object is met.
+        """
+        ndarray, generic = _numpy_types()
+        if isinstance(x, ndarray):
+            return XManager._jsonfy_ndarray(x)
+        # Such as `np.int64`, which orjson rejects.
+        if isinstance(x, generic):
+            return x.item()
+        if isinstance(x, enum.Enum):
+            return x.value
+        if isinstance(x, uuid.UUID):
+            return str(x)
+        # The subclasses of the builtin types, which orjson passes through,
+        # are serialized as `json` does.
         if isinstance(x, dict):
-            return {
-                k: XManager.jsonfy(v)
-                for k, v in x.items()
-            }
+            return dict(x)
         if isinstance(x, (list, tuple)):
-            return [XManager.jsonfy(xi) for xi in x]
-        # TODO: convert other objects which are not JSON serializable.
-        if not hasattr(x, '__dict__'):
-            # Check serializablility.
-            try:
-                json.dumps(x)
-            except TypeError:
-                raise TypeError(f'Type "{type(x)}" is not JSON-serializable.')
-            return x
- 
-        json_dict : Dict[str, Any] = {}
-        for k, v in x.__dict__.items():
-            json_dict[k] = XManager.jsonfy(v)
-        return json_dict
+            return list(x)
+        for base in (str, int, float):
+            if isinstance(x, base):
+                return base(x)
+        if hasattr(x, '__dict__'):
+            return {k: v for k, v in vars(x).items() if not k.startswith('_')}
+        raise TypeError(f'Type "{type(x)}" is not JSON-serializable.')
 
     def get_params(self):
-        params = XManager.jsonfy(self)
-        del params['x_dir']
-        return params
-
-    def save_params(self):
-        """Save the parameters as JSON to `params.json`."""
-        with open(self.get_path('params.json'), 'w') as f:
-            json.dump(self.get_params(), f, indent=2)
+        return XManager.jsonfy(self.__dict__)
+
+    def _dump_params(self) -> bytes:
+        """Returns the parameters serialized as JSON."""
+        # The parameters are passed without JSONfying, and the encoder calls
+        # `_json_default` only for what it cannot serialize natively. So, no
+        # copy of the parameters is made.
+        if orjson is not None:
+            try:
+                data = orjson.dumps(
+                    self.__dict__,
+                    option=_ORJSON_OPTIONS,
+                    default=XManager._json_default,
+                )
+            except orjson.JSONEncodeError:
+                # Such as the integers beyond 64-bit and the non-str keys,
+                # which `json` supports.
+                pass
+            else:
+                # NaN and infinities are written as `null` by orjson, so fall
+                # back to `json` for them.
+                if b'null' not in data or not _has_nonfinite(self.__dict__):
+                    return data
+        return _json_encoder.encode(self.__dict__).encode()
+
+    def _wait_writer(self):
+        """Waits for the background writing of `params.json`, if any, and
+        raises its error.
+        """
+        writer, self._writer = self._writer, None
+        if writer is not None:
+            writer.join()
+
+    def save_params(self, async_io=False):
+        """Save the parameters as JSON to `params.json`.
+
+        Large arrays are saved as base64 encoded bytes, which can be recovered
+        by `XManager.unjsonfy` after loading the JSON.
+
+        Args:
+            async_io (bool, optional): If true, write the file in a background
+                thread, so that a large dump does not block the caller. The
+                parameters are serialized before returning, so they can be
+                modified right after.
+
+        Returns:
+            Optional[threading.Thread]: The thread writing the file, if
+                `async_io` is true and the dump is large enough. Join it to
+                wait for the writing, which raises the error of the writing,
+                if any. Otherwise `None`.
+
+        Raises:
+            Exception: The error of the previous background writing, if it has
+                not been raised by joining its thread.
+        """
+        # The previous writing has to end first, so that it will not overwrite
+        # this one.
+        self._wait_writer()
+
+        path = self.get_path('params.json')
+        if orjson is None and not async_io:
+            # Stream to the file without building the whole dump in memory.
+            def write(f):
+                for chunk in _json_encoder.iterencode(self.__dict__):
+                    f.write(chunk.encode())
+            _replace_file(path, write)
+            return None
+
+        data = self._dump_params()
+        # For small dumps, the thread costs more than the writing.
+        if async_io and len(data) >= _ASYNC_IO_MIN_SIZE:
+            self._writer = _ParamsWriter(path, data)
+            self._writer.start()
+            return self._writer
+        _replace_file(path, lambda f: f.write(data))
+        return None
+
+
+# The encoder of `json` used when orjson is absent. It is built once, instead
+# of by each `json.dump` call with non-default arguments.
+_json_encoder = json.JSONEncoder(indent=2, default=XManager._json_default)